@@ -0,0 +1,128 @@
+from starlette.concurrency import run_in_threadpool
+from profiling import current_profiler
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from collections import deque
+import asyncio
+import math
+import time
+
+
+class Overloaded(Exception):
+    """Raised when a stage's queue is full and the request should be shed."""
+
+    def __init__(self, stage: str, retry_after: int):
+        super().__init__(f"Stage '{stage}' is overloaded, retry after {retry_after}s")
+        self.stage = stage
+        self.retry_after = retry_after
+
+
+class StageLimiter:
+    """
+    Concurrency limit plus a bounded wait queue for one pipeline stage.
+
+    Priority requests (cheap, cache-backed paths) are woken before normal
+    ones. Each kind has its own bounded queue: a request is rejected with
+    Overloaded once ``max_queue`` (or ``max_priority_queue``) requests of
+    its kind are already waiting.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int, max_priority_queue: Optional[int] = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_priority_queue = max_queue if max_priority_queue is None else max_priority_queue
+        self.active = 0
+        self._priority_waiters: deque = deque()
+        self._waiters: deque = deque()
+        # Exponentially weighted average stage duration, for Retry-After
+        self._avg_seconds = 1.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._priority_waiters) + len(self._waiters)
+
+    def retry_after(self) -> int:
+        backlog = self.queued + self.active
+        return max(1, math.ceil(self._avg_seconds * backlog / max(self.concurrency, 1)))
+
+    async def acquire(self, priority: bool = False):
+        if self.active < self.concurrency and not self.queued:
+            self.active += 1
+            return
+
+        queue, limit = (
+            (self._priority_waiters, self.max_priority_queue) if priority
+            else (self._waiters, self.max_queue)
+        )
+        if len(queue) >= limit:
+            raise Overloaded(self.name, self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was handed over just before cancellation; pass it on
+                self.release()
+            else:
+                for queue in (self._priority_waiters, self._waiters):
+                    if waiter in queue:
+                        queue.remove(waiter)
+            raise
+
+    def release(self):
+        for queue in (self._priority_waiters, self._waiters):
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # Hand the slot straight to the next waiter; active is unchanged
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
+
+    def record(self, seconds: float):
+        self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * seconds
+
+
+class AdmissionController:
+    """Per-stage admission control for the blocking provider calls."""
+
+    def __init__(self, limits: Dict[str, int], max_queue: int, max_priority_queue: Optional[int] = None):
+        self.stages = {
+            name: StageLimiter(name, concurrency, max_queue, max_priority_queue)
+            for name, concurrency in limits.items()
+        }
+
+    async def run(self, stage: str, fn: Callable, *args, priority: bool = False, **kwargs) -> Any:
+        """Run a blocking ``fn`` in the threadpool once ``stage`` admits it."""
+        limiter = self.stages[stage]
+        fn = current_profiler.get().wrap(stage, fn)
+        await limiter.acquire(priority=priority)
+        start = time.time()
+        try:
+            return await run_in_threadpool(fn, *args, **kwargs)
+        finally:
+            limiter.record(time.time() - start)
+            limiter.release()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one execution.
+    The shared task is shielded, so one caller disconnecting does not cancel
+    the work the others are waiting on.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Returns (result, shared) where shared is True for coalesced callers."""
+        task: Optional[asyncio.Task] = self._inflight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task), shared
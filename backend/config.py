@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Literal, Optional
 
 
 class Settings(BaseSettings):
@@ -22,6 +23,57 @@ class Settings(BaseSettings):
     top_k_retrieval: int = 8
     top_k_rerank: int = 4
     
+    # Shared local index (memory-mapped, shared across uvicorn workers).
+    # Disabled when shared_index_dir is unset; search then goes to Supabase RPC.
+    shared_index_dir: Optional[str] = None
+    shared_index_refresh_seconds: float = 2.0
+    shared_index_compact_seconds: float = 300.0
+    shared_index_max_segments: int = 8
+    # Segments with at least this share of superseded rows are rewritten
+    shared_index_compact_dead_ratio: float = 0.3
+    # How often to check Supabase for changes made elsewhere (0 disables)
+    shared_index_resync_seconds: float = 300.0
+    
+    # Conversation sessions
+    session_ttl_seconds: float = 1800
+    session_max_sessions: int = 1000
+    session_max_turns: int = 5
+    session_reuse_threshold: float = 0.6
+    # A follow-up reuses the pool only if its best match is at least this
+    # fraction of the previous turn's best match
+    session_reuse_ratio: float = 0.9
+    session_extend_top_k: int = 4
+    # Without SHARED_INDEX_DIR, how often each worker polls Supabase for
+    # ingests made by other workers or hosts (0 disables the poll)
+    session_version_poll_seconds: float = 10.0
+    
+    # Near-duplicate chunk detection (MinHash/LSH)
+    dedup_enabled: bool = True
+    dedup_index_path: str = "dedup_index.sqlite"
+    dedup_threshold: float = 0.85
+    # "link" stores near-duplicates with their canonical chunk's embedding;
+    # "skip" drops them, so their text is lost if the canonical's source is
+    # later replaced
+    dedup_mode: Literal["link", "skip"] = "link"
+    
+    # Admission control: concurrent calls per pipeline stage, and how many
+    # requests may wait per stage before new ones are shed with 429
+    admission_embed_concurrency: int = 4
+    admission_search_concurrency: int = 8
+    admission_rerank_concurrency: int = 4
+    admission_llm_concurrency: int = 4
+    admission_queue_size: int = 16
+    # Separate wait queue for repeated session questions, which skip the queue above
+    admission_priority_queue_size: int = 16
+    
+    # Opt-in request profiling (?profile=true on /ingest and /query)
+    profiling_enabled: bool = False
+    profiling_max_profiles: int = 20
+    profiling_sample_interval: float = 0.005
+    
+    # Offline stand-ins for the embedding, rerank, LLM and database providers
+    use_stub_providers: bool = False
+    
     class Config:
         env_file = ".env"
         case_sensitive = False
@@ -1,25 +1,217 @@
 from supabase import create_client, Client
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional
 from config import get_settings
+from shared_index import SharedIndex
+import json
+import threading
+import time
 import uuid
 
 
 class VectorDatabase:
-    def __init__(self):
+    def __init__(self, start_background: bool = True):
+        """
+        With ``start_background`` False (one-off tools such as snapshot.py),
+        the shared index is opened as is: no backfill from Supabase and no
+        refresh, compaction or resync threads.
+        """
         self.settings = get_settings()
         self.client: Client = create_client(
             self.settings.supabase_url,
             self.settings.supabase_service_key
         )
         self.table_name = "documents"
+        
+        # Optional local read replica shared by all workers on this host
+        self.local_index: Optional[SharedIndex] = None
+        if self.settings.shared_index_dir:
+            self.local_index = SharedIndex(
+                self.settings.shared_index_dir,
+                dimension=self.settings.embedding_dimension,
+                refresh_interval=self.settings.shared_index_refresh_seconds,
+                compact_interval=self.settings.shared_index_compact_seconds,
+                max_segments=self.settings.shared_index_max_segments,
+                compact_dead_ratio=self.settings.shared_index_compact_dead_ratio
+            )
+            if start_background:
+                if self.local_index.is_empty():
+                    self.sync_local_index()
+                self.local_index.start()
+                if self.settings.shared_index_resync_seconds > 0:
+                    threading.Thread(target=self._resync_loop, daemon=True).start()
     
-    def delete_by_source(self, source: str):
-        """Delete all documents with the given source."""
+    @staticmethod
+    def parse_embedding(value) -> List[float]:
+        """PostgREST returns pgvector columns as strings like "[0.1,0.2,...]"."""
+        if isinstance(value, str):
+            return json.loads(value)
+        return list(value)
+    
+    def iter_documents(self, batch_size: int = 1000, with_embeddings: bool = True) -> Iterator[List[Dict]]:
+        """
+        Page through every stored chunk, ordered by source and chunk index.
+        Embeddings are returned as lists of floats. PostgREST may return
+        fewer rows than asked for (its max-rows cap), so only an empty page
+        ends the scan.
+        """
+        columns = "id, content, source, title, section, chunk_index"
+        if with_embeddings:
+            columns += ", embedding"
+        
+        start = 0
+        while True:
+            page = self.client.table(self.table_name).select(columns).order("source").order(
+                "chunk_index"
+            ).order("id").range(start, start + batch_size - 1).execute()
+            rows = page.data or []
+            if not rows:
+                break
+            
+            yield self._with_parsed_embeddings(rows)
+            start += len(rows)
+    
+    def iter_source_batches(self, batch_size: int = 1000) -> Iterator[List[Dict]]:
+        """Like iter_documents, but never splits one source across two batches."""
+        pending: List[Dict] = []
+        for rows in self.iter_documents(batch_size):
+            for row in rows:
+                if len(pending) >= batch_size and pending[-1]["source"] != row["source"]:
+                    yield pending
+                    pending = []
+                pending.append(row)
+        if pending:
+            yield pending
+    
+    def _with_parsed_embeddings(self, rows: List[Dict]) -> List[Dict]:
+        for row in rows:
+            if row.get("embedding") is not None:
+                row["embedding"] = self.parse_embedding(row["embedding"])
+        return rows
+    
+    def count_documents(self) -> int:
+        """Exact number of stored chunks."""
+        result = self.client.table(self.table_name).select("id", count="exact").limit(1).execute()
+        return result.count or 0
+    
+    def corpus_fingerprint(self) -> str:
+        """
+        Cheap change marker for the documents table: row count plus newest
+        created_at. Any insert, re-ingest or delete changes it.
+        """
+        result = self.client.table(self.table_name).select(
+            "created_at", count="exact"
+        ).order("created_at", desc=True).limit(1).execute()
+        latest = result.data[0]["created_at"] if result.data else ""
+        return f"{result.count}:{latest}"
+    
+    def _local_batches(self, batch_size: int = 1000):
+        return (
+            (rows, [row["embedding"] for row in rows])
+            for rows in self.iter_source_batches(batch_size)
+        )
+    
+    def sync_local_index(self, batch_size: int = 1000):
+        """Backfill the shared local index from Supabase if no worker has done so yet."""
+        if self.local_index is None:
+            return
+        
+        # Taken before the scan, so changes made during it trigger a later resync
+        fingerprint = self.corpus_fingerprint()
+        total = self.local_index.bulk_load(
+            self._local_batches(batch_size), only_if_empty=True, fingerprint=fingerprint
+        )
+        if total:
+            print(f"Shared index synced {total} documents from Supabase")
+    
+    def resync_local_index(self, batch_size: int = 1000) -> bool:
+        """
+        Rebuild the shared local index if Supabase changed outside this host's
+        knowledge (ingest on another host, manual deletes). Returns True if rebuilt.
+        """
+        if self.local_index is None:
+            return False
+        
+        fingerprint = self.corpus_fingerprint()
+        if self.local_index.fingerprint() == fingerprint:
+            return False
+        return self.local_index.resync(fingerprint, self._local_batches(batch_size))
+    
+    def _resync_loop(self):
+        interval = self.settings.shared_index_resync_seconds
+        while True:
+            time.sleep(interval)
+            try:
+                self.resync_local_index()
+            except Exception as e:
+                print(f"Shared index resync error: {e}")
+    
+    def _local_fingerprint(self) -> Optional[str]:
+        """Fingerprint to record after a local write, or None if it can't be read."""
+        try:
+            return self.corpus_fingerprint()
+        except Exception as e:
+            print(f"Error reading corpus fingerprint: {e}")
+            return None
+    
+    def _delete_rows(self, source: str):
+        """Delete the Supabase rows of ``source`` without touching the local index."""
         try:
             self.client.table(self.table_name).delete().eq("source", source).execute()
         except Exception as e:
             print(f"Error deleting documents: {e}")
     
+    def delete_by_source(self, source: str):
+        """Delete all documents with the given source."""
+        self._delete_rows(source)
+        if self.local_index is not None:
+            self.local_index.delete_sources([source], fingerprint=self._local_fingerprint())
+    
+    def _ids_for_sources(self, sources: List[str], batch_size: int = 1000) -> List[str]:
+        """All stored chunk ids of the given sources."""
+        ids = []
+        for i in range(0, len(sources), 100):
+            start = 0
+            while True:
+                page = self.client.table(self.table_name).select("id").in_(
+                    "source", sources[i:i + 100]
+                ).order("id").range(start, start + batch_size - 1).execute()
+                rows = page.data or []
+                if not rows:
+                    break
+                ids.extend(row["id"] for row in rows)
+                start += len(rows)
+        return ids
+    
+    def replace_sources(self, records: List[Dict], batch_size: int = 500):
+        """
+        Replace every source in ``records`` with those complete records
+        (including id and embedding). Callers must pass whole sources.
+
+        Records are upserted on id first, and only then are the sources' rows
+        that are not among them deleted. Queries never see a source vanish,
+        though until the delete they may see old and new rows side by side.
+        An interrupted call leaves extra stale rows, not missing ones, and
+        re-running it completes the replacement.
+        """
+        for i in range(0, len(records), batch_size):
+            batch = records[i:i + batch_size]
+            self.client.table(self.table_name).upsert(batch).execute()
+        
+        sources = sorted({record["source"] for record in records})
+        keep = {record["id"] for record in records}
+        stale = [row_id for row_id in self._ids_for_sources(sources) if row_id not in keep]
+        for i in range(0, len(stale), 100):
+            self.client.table(self.table_name).delete().in_("id", stale[i:i + 100]).execute()
+        
+        # The append supersedes these sources in the local index in one publish
+
+        if self.local_index is not None and records:
+            self.local_index.append(
+                [{k: v for k, v in record.items() if k != "embedding"} for record in records],
+                [record["embedding"] for record in records],
+                fingerprint=self._local_fingerprint()
+            )
+    
     def upsert_documents(self, chunks: List[Dict], embeddings: List[List[float]]):
         """
         Upsert document chunks with embeddings into the database.
@@ -28,15 +220,16 @@ class VectorDatabase:
         if not chunks or not embeddings:
             return
         
-        # Delete existing documents from this source
+        # Delete existing documents from this source. The local index is left
+        # alone: the append below supersedes the source in a single publish.
         source = chunks[0]["source"]
-        self.delete_by_source(source)
+        self._delete_rows(source)
         
         # Prepare records
         records = []
         for chunk, embedding in zip(chunks, embeddings):
             record = {
-                "id": str(uuid.uuid4()),
+                "id": chunk.get("id") or str(uuid.uuid4()),
                 "content": chunk["content"],
                 "embedding": embedding,
                 "source": chunk["source"],
@@ -51,12 +244,30 @@ class VectorDatabase:
         for i in range(0, len(records), batch_size):
             batch = records[i:i + batch_size]
             self.client.table(self.table_name).insert(batch).execute()
+        
+        # Publish to the shared index; other workers pick it up on their next refresh
+        if self.local_index is not None:
+            self.local_index.append(
+                [{k: v for k, v in record.items() if k != "embedding"} for record in records],
+                embeddings,
+                fingerprint=self._local_fingerprint()
+            )
+    
+    def get_embeddings(self, ids: List[str]) -> Dict[str, List[float]]:
+        """Fetch stored embeddings for the given chunk ids."""
+        if not ids:
+            return {}
+        result = self.client.table(self.table_name).select("id, embedding").in_("id", ids).execute()
+        return {row["id"]: self.parse_embedding(row["embedding"]) for row in (result.data or [])}
     
     def similarity_search(self, query_embedding: List[float], top_k: int = 8) -> List[Dict]:
         """
         Perform similarity search using pgvector.
         Returns top-k most similar documents.
         """
+        if self.local_index is not None and not self.local_index.is_empty():
+            return self.local_index.search(query_embedding, top_k=top_k)
+        
         try:
             # Use RPC function for vector similarity search
             result = self.client.rpc(
@@ -72,7 +283,7 @@ class VectorDatabase:
             print(f"DEBUG: Similarity search returned {len(result.data) if result.data else 0} results")
             
             if result.data and len(result.data) > 0:
-                return result.data
+                return self._with_parsed_embeddings(result.data)
             
             # If RPC returned 0 results, fall back to simple query
             print("WARNING: RPC returned 0 results, using fallback...")
@@ -87,7 +298,7 @@ class VectorDatabase:
                 if all_docs.data and len(all_docs.data) > 0:
                     print(f"DEBUG: Fallback found {len(all_docs.data)} total documents")
                     # Return up to top_k documents (not ideal but works)
-                    return all_docs.data[:top_k]
+                    return self._with_parsed_embeddings(all_docs.data[:top_k])
                 else:
                     print("ERROR: No documents in database!")
                     return []
@@ -0,0 +1,322 @@
+import numpy as np
+from typing import List, Dict, Iterable, Optional, Tuple
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import uuid
+
+
+class MinHasher:
+    """MinHash signatures over word shingles, for estimating Jaccard similarity."""
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 3, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        # a, b < 2**32 and shingle hashes < 2**32 keep a * x + b inside uint64
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def _shingles(self, text: str) -> List[str]:
+        words = re.findall(r"\w+", text.lower())
+        if len(words) < self.shingle_size:
+            return [" ".join(words)] if words else []
+        return [" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = set(self._shingles(text))
+        if not shingles:
+            return np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles)
+        )
+        permuted = (np.outer(hashes, self._a) + self._b) % np.uint64(self._PRIME)
+        return (permuted & np.uint64(0xFFFFFFFF)).min(axis=0).astype(np.uint32)
+
+    @staticmethod
+    def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+        """Estimated Jaccard similarity of two signatures."""
+        return float(np.mean(sig_a == sig_b))
+
+
+class ChunkDeduplicator:
+    """
+    Persistent MinHash/LSH index of stored chunks, keyed by chunk id.
+
+    Ingest uses ``filter_chunks`` to split new chunks into unique ones and
+    near-duplicates of chunks already stored (or earlier in the same batch),
+    then ``commit`` to record what was actually stored. Query uses
+    ``collapse`` to drop near-identical search results.
+
+    The index is a SQLite database shared by all workers. Each chunk row
+    records its canonical chunk (NULL for canonical chunks themselves), and
+    only canonical chunks are entered in the LSH bands, so duplicates always
+    link to a canonical. Commits update one source's rows incrementally
+    under an flock; readers query the database directly and never reload.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS chunks (
+            id TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            canonical_id TEXT,
+            sig BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source);
+        CREATE INDEX IF NOT EXISTS chunks_canonical ON chunks (canonical_id);
+        CREATE TABLE IF NOT EXISTS bands (key INTEGER NOT NULL, chunk_id TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS bands_key ON bands (key);
+        CREATE INDEX IF NOT EXISTS bands_chunk ON bands (chunk_id);
+    """
+
+    def __init__(
+        self,
+        path: str,
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        bands: int = 16
+    ):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.hasher = MinHasher(num_perm=num_perm)
+        # Signatures built with a different layout can't be compared
+        self.layout = f"{num_perm}x{bands}"
+
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with self._locked():
+            self._connection().executescript(self._SCHEMA)
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread; ingest calls run in the threadpool."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _locked(self):
+        with open(f"{self.path}.lock", "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; callers hold the flock, so it never waits on SQLite."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def exists(self) -> bool:
+        """True once the index has been built with the current signature layout."""
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+        return row is not None and row[0] == self.layout
+
+    # ------------------------------------------------------------------
+    # LSH index
+    # ------------------------------------------------------------------
+
+    def _band_keys(self, sig: np.ndarray) -> List[int]:
+        keys = []
+        for band in range(self.bands):
+            rows = sig[band * self.rows_per_band:(band + 1) * self.rows_per_band]
+            digest = hashlib.blake2b(bytes([band]) + rows.tobytes(), digest_size=8).digest()
+            keys.append(int.from_bytes(digest, "little", signed=True))
+        return keys
+
+    @staticmethod
+    def _sig_from_blob(blob: bytes) -> np.ndarray:
+        return np.frombuffer(blob, dtype=np.uint32)
+
+    def _insert(self, connection: sqlite3.Connection, chunk_id: str, source: str, sig: np.ndarray, canonical_id: Optional[str] = None):
+        connection.execute(
+            "INSERT OR REPLACE INTO chunks (id, source, canonical_id, sig) VALUES (?, ?, ?, ?)",
+            (chunk_id, source, canonical_id, sig.astype(np.uint32).tobytes())
+        )
+        if canonical_id is None:
+            connection.executemany(
+                "INSERT INTO bands (key, chunk_id) VALUES (?, ?)",
+                [(key, chunk_id) for key in self._band_keys(sig)]
+            )
+
+    def _remove_source(self, connection: sqlite3.Connection, source: str):
+        """
+        Delete a source's rows. Canonical chunks that other sources still link
+        to hand their role to the first such dependant, which is entered in
+        the bands in their place, so no stored chunk loses its canonical.
+        """
+        orphaned = connection.execute(
+            "SELECT d.canonical_id, d.id, d.sig FROM chunks d JOIN chunks c ON c.id = d.canonical_id "
+            "WHERE c.source = ? AND d.source != ? ORDER BY d.canonical_id, d.source, d.id",
+            (source, source)
+        ).fetchall()
+
+        promoted: Dict[str, str] = {}
+        for old_id, chunk_id, blob in orphaned:
+            if old_id not in promoted:
+                promoted[old_id] = chunk_id
+                connection.execute("UPDATE chunks SET canonical_id = NULL WHERE id = ?", (chunk_id,))
+                connection.executemany(
+                    "INSERT INTO bands (key, chunk_id) VALUES (?, ?)",
+                    [(key, chunk_id) for key in self._band_keys(self._sig_from_blob(blob))]
+                )
+            else:
+                connection.execute("UPDATE chunks SET canonical_id = ? WHERE id = ?", (promoted[old_id], chunk_id))
+
+        connection.execute("DELETE FROM bands WHERE chunk_id IN (SELECT id FROM chunks WHERE source = ?)", (source,))
+        connection.execute("DELETE FROM chunks WHERE source = ?", (source,))
+
+    def _find_canonical(
+        self,
+        connection: sqlite3.Connection,
+        sig: np.ndarray,
+        exclude_source: Optional[str] = None
+    ) -> Optional[Tuple[str, float]]:
+        """Best indexed canonical match at or above the threshold, as (chunk_id, similarity)."""
+        keys = self._band_keys(sig)
+        rows = connection.execute(
+            f"SELECT DISTINCT c.id, c.source, c.sig FROM bands b JOIN chunks c ON c.id = b.chunk_id "
+            f"WHERE b.key IN ({','.join('?' * len(keys))})",
+            keys
+        ).fetchall()
+
+        best = None
+        for chunk_id, source, blob in rows:
+            if exclude_source is not None and source == exclude_source:
+                continue
+            similarity = MinHasher.similarity(sig, self._sig_from_blob(blob))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (chunk_id, similarity)
+        return best
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def filter_chunks(self, chunks: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Split chunks into (unique, duplicates).
+
+        Every chunk gets an ``id`` if it lacks one. Duplicates carry
+        ``canonical_id`` and ``duplicate_similarity``. Rows of the chunks' own
+        source are ignored, since ingest replaces that source wholesale.
+        """
+        connection = self._connection()
+        unique: List[Dict] = []
+        duplicates: List[Dict] = []
+        batch_sigs: List[Tuple[str, np.ndarray]] = []
+
+        for chunk in chunks:
+            chunk.setdefault("id", str(uuid.uuid4()))
+            sig = self.hasher.signature(chunk["content"])
+            chunk["_minhash"] = sig
+            match = self._find_canonical(connection, sig, exclude_source=chunk["source"])
+
+            if match is None:
+                for chunk_id, other in batch_sigs:
+                    similarity = MinHasher.similarity(sig, other)
+                    if similarity >= self.threshold:
+                        match = (chunk_id, similarity)
+                        break
+
+            if match is not None:
+                chunk["canonical_id"], chunk["duplicate_similarity"] = match
+                duplicates.append(chunk)
+            else:
+                batch_sigs.append((chunk["id"], sig))
+                unique.append(chunk)
+
+        return unique, duplicates
+
+    def commit(self, source: str, unique: List[Dict], linked: Optional[List[Dict]] = None):
+        """
+        Replace the indexed chunks of ``source`` with what was stored:
+        ``unique`` chunks become canonical, ``linked`` chunks keep their
+        ``canonical_id``.
+        """
+        with self._locked(), self._transaction() as connection:
+            self._remove_source(connection, source)
+            for chunk in unique:
+                sig = chunk.pop("_minhash", None)
+                if sig is None:
+                    sig = self.hasher.signature(chunk["content"])
+                self._insert(connection, chunk["id"], source, sig)
+
+            for chunk in linked or []:
+                sig = chunk.pop("_minhash", None)
+                if sig is None:
+                    sig = self.hasher.signature(chunk["content"])
+                canonical_id = chunk["canonical_id"]
+                exists = connection.execute("SELECT 1 FROM chunks WHERE id = ?", (canonical_id,)).fetchone()
+                # A canonical removed since filtering leaves this chunk as its own canonical
+                self._insert(connection, chunk["id"], source, sig, canonical_id if exists else None)
+
+    def rebuild(self, batches: Iterable[List[Dict]], only_if_missing: bool = False) -> Optional[int]:
+        """
+        Rebuild the index from stored rows (dicts with id, source, content),
+        relinking each row to the first earlier canonical it duplicates.
+
+        With ``only_if_missing``, the check is repeated under the lock and
+        None is returned if another worker has already built the index.
+        """
+        with self._locked():
+            if only_if_missing and self.exists():
+                return None
+
+            with self._transaction() as connection:
+                connection.execute("DELETE FROM bands")
+                connection.execute("DELETE FROM chunks")
+                total = 0
+                for rows in batches:
+                    for row in rows:
+                        sig = self.hasher.signature(row["content"])
+                        match = self._find_canonical(connection, sig)
+                        self._insert(connection, row["id"], row["source"], sig, match[0] if match else None)
+                        total += 1
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('layout', ?)",
+                    (self.layout,)
+                )
+        return total
+
+    def collapse(self, docs: List[Dict]) -> List[Dict]:
+        """Drop results that near-duplicate a higher-ranked result, keeping order."""
+        kept: List[Dict] = []
+        kept_sigs: List[np.ndarray] = []
+        for doc in docs:
+            sig = self.hasher.signature(doc.get("content", ""))
+            if any(MinHasher.similarity(sig, other) >= self.threshold for other in kept_sigs):
+                continue
+            kept.append(doc)
+            kept_sigs.append(sig)
+        return kept
@@ -1,18 +1,35 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, List, Dict
+from contextlib import contextmanager
 import time
 from datetime import datetime
 
 from chunker import TextChunker
-from embedder import Embedder
-from database import VectorDatabase
-from reranker import Reranker
-from llm import LLMAnswerer
 from file_processor import FileProcessor
+from session_cache import SessionStore, Session, cosine_scores
+from dedup import ChunkDeduplicator
+from admission import AdmissionController, Overloaded, SingleFlight
+from profiling import ProfileStore, current_profiler
 from config import get_settings
 
+settings = get_settings()
+if settings.use_stub_providers:
+    from stub_providers import (
+        StubEmbedder as Embedder,
+        StubVectorDatabase as VectorDatabase,
+        StubReranker as Reranker,
+        StubLLMAnswerer as LLMAnswerer
+    )
+else:
+    from embedder import Embedder
+    from database import VectorDatabase
+    from reranker import Reranker
+    from llm import LLMAnswerer
+
 app = FastAPI(title="RAG Application API", version="1.0.0")
 
 # CORS middleware
@@ -25,13 +42,53 @@ app.add_middleware(
 )
 
 # Initialize components
-settings = get_settings()
 chunker = TextChunker(chunk_size=settings.chunk_size, overlap=settings.chunk_overlap)
 embedder = Embedder()
 db = VectorDatabase()
 reranker = Reranker()
 llm = LLMAnswerer()
 file_processor = FileProcessor()
+sessions = SessionStore(
+    ttl_seconds=settings.session_ttl_seconds,
+    max_sessions=settings.session_max_sessions,
+    max_turns=settings.session_max_turns,
+    # Other workers' ingests show up as a new shared index generation, or
+    # without one, as a new Supabase corpus fingerprint
+    version_fn=(
+        (lambda: db.local_index.generation) if db.local_index is not None
+        else db.corpus_fingerprint if settings.session_version_poll_seconds > 0
+        else None
+    ),
+    version_poll_seconds=0.0 if db.local_index is not None else settings.session_version_poll_seconds
+)
+
+admission = AdmissionController(
+    {
+        "embed": settings.admission_embed_concurrency,
+        "search": settings.admission_search_concurrency,
+        "rerank": settings.admission_rerank_concurrency,
+        "llm": settings.admission_llm_concurrency
+    },
+    max_queue=settings.admission_queue_size,
+    max_priority_queue=settings.admission_priority_queue_size
+)
+single_flight = SingleFlight()
+# /ingest and /query calls in flight in this worker
+active_requests = 0
+profiles = ProfileStore(
+    max_profiles=settings.profiling_max_profiles,
+    sample_interval=settings.profiling_sample_interval,
+    active_fn=lambda: active_requests
+)
+
+deduplicator = None
+if settings.dedup_enabled:
+    deduplicator = ChunkDeduplicator(settings.dedup_index_path, threshold=settings.dedup_threshold)
+    if not deduplicator.exists():
+        # Workers start together; only the first to take the lock builds it
+        indexed = deduplicator.rebuild(db.iter_documents(with_embeddings=False), only_if_missing=True)
+        if indexed is not None:
+            print(f"Dedup index built from {indexed} stored chunks")
 
 
 class IngestTextRequest(BaseModel):
@@ -41,6 +98,7 @@ class IngestTextRequest(BaseModel):
 
 class QueryRequest(BaseModel):
     question: str
+    session_id: Optional[str] = None
 
 
 class Citation(BaseModel):
@@ -57,6 +115,8 @@ class QueryResponse(BaseModel):
     input_tokens: int
     output_tokens: int
     warning: Optional[str] = None
+    session_id: Optional[str] = None
+    profile_id: Optional[str] = None
 
 
 @app.get("/")
@@ -66,16 +126,61 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "POST /ingest": "Ingest text or file",
-            "POST /query": "Query the knowledge base"
+            "POST /query": "Query the knowledge base",
+            "POST /sessions": "Start a conversation session for follow-up queries"
         }
     }
 
 
+async def count_active_requests(request: Request, call_next):
+    """Track in-flight pipeline requests, so profiles can tell if they ran alone."""
+    global active_requests
+    if request.url.path not in ("/ingest", "/query"):
+        return await call_next(request)
+    
+    active_requests += 1
+    try:
+        return await call_next(request)
+    finally:
+        active_requests -= 1
+
+
+# Only installed when profiling is enabled, so other deployments pay nothing
+if settings.profiling_enabled:
+    app.middleware("http")(count_active_requests)
+
+
+@contextmanager
+def request_profiler(enabled: bool, kind: str):
+    """Profile the enclosed request if asked to; yields the profiler or None."""
+    if not enabled:
+        yield None
+        return
+    
+    if not settings.profiling_enabled:
+        raise HTTPException(status_code=403, detail="Profiling is disabled. Set PROFILING_ENABLED=true to enable it.")
+    
+    # Memory tracing is process-wide, so start only on an otherwise idle worker
+    if active_requests > 1:
+        raise HTTPException(status_code=409, detail="Other requests are in flight on this worker; retry profiling when it is idle")
+    
+    with profiles.profile(kind) as profiler:
+        if profiler is None:
+            raise HTTPException(status_code=409, detail="Another request is already being profiled")
+        yield profiler
+
+
+async def run_blocking(stage: str, fn, *args, **kwargs):
+    """Run a blocking call in the threadpool, profiled as ``stage``."""
+    return await run_in_threadpool(current_profiler.get().wrap(stage, fn), *args, **kwargs)
+
+
 @app.post("/ingest")
 async def ingest(
     text: Optional[str] = Form(None),
     source_name: Optional[str] = Form("pasted_text"),
-    file: Optional[UploadFile] = File(None)
+    file: Optional[UploadFile] = File(None),
+    profile: bool = False
 ):
     """
     Ingest text or file into the vector database.
@@ -83,7 +188,19 @@ async def ingest(
     - text: Direct text input
     - source_name: Name for the source (default: "pasted_text")
     - file: Upload PDF or TXT file
+    - profile: Capture a CPU/memory profile of this call (query parameter,
+      requires PROFILING_ENABLED); download it from /profiles/{profile_id}
     """
+    with request_profiler(profile, "ingest") as profiler:
+        result = await ingest_content(text, file)
+    
+    if profiler is not None:
+        result["profile_id"] = profiler.id
+    return result
+
+
+async def ingest_content(text: Optional[str], file: Optional[UploadFile]) -> Dict:
+    """Extract, chunk, deduplicate, embed and store one upload."""
     start_time = time.time()
     
     try:
@@ -91,7 +208,7 @@ async def ingest(
         if file:
             # Process uploaded file
             file_content = await file.read()
-            content = file_processor.process_file(file.filename, file_content)
+            content = await run_blocking("extraction", file_processor.process_file, file.filename, file_content)
             source = file.filename
         elif text:
             # Use provided text with unique timestamp
@@ -105,17 +222,66 @@ async def ingest(
             raise HTTPException(status_code=400, detail="Content is too short or empty")
         
         # Chunk the content
-        chunks = chunker.chunk_text(content, source=source, title=source)
+        chunks = await run_blocking("chunking", chunker.chunk_text, content, source=source, title=source)
         
         if not chunks:
             raise HTTPException(status_code=400, detail="No chunks generated from content")
         
+        # Find near-duplicates of already stored chunks before embedding
+        duplicates = []
+        if deduplicator is not None:
+            chunks, duplicates = await run_blocking("dedup", deduplicator.filter_chunks, chunks)
+            if duplicates:
+                print(f"Dedup: {len(duplicates)} near-duplicate chunks in {source}")
+        
+        linked = []
+        skipped = []
+        canonical_embeddings = {}
+        if duplicates and settings.dedup_mode == "link":
+            # Store duplicates too, reusing their canonical chunk's embedding
+            batch_ids = {chunk["id"] for chunk in chunks}
+            stored_ids = [d["canonical_id"] for d in duplicates if d["canonical_id"] not in batch_ids]
+            if stored_ids:
+                canonical_embeddings = await run_blocking("dedup", db.get_embeddings, stored_ids)
+            for duplicate in duplicates:
+                if duplicate["canonical_id"] in batch_ids or duplicate["canonical_id"] in canonical_embeddings:
+                    linked.append(duplicate)
+                else:
+                    # Canonical row is gone; embed and store this chunk as unique
+                    del duplicate["canonical_id"], duplicate["duplicate_similarity"]
+                    chunks.append(duplicate)
+        else:
+            skipped = duplicates
+        
+        if not chunks and not linked:
+            # Every chunk duplicates stored content; keep the source's existing rows
+            return {
+                "message": "No new content stored: every chunk duplicates content already in the knowledge base",
+                "source": source,
+                "chunks_created": 0,
+                "duplicates_skipped": len(skipped),
+                "duplicates_linked": 0,
+                "latency_ms": int((time.time() - start_time) * 1000)
+            }
+        
         # Generate embeddings
         texts = [chunk["content"] for chunk in chunks]
-        embeddings = embedder.embed_texts(texts)
+        embeddings = await admission.run("embed", embedder.embed_texts, texts) if texts else []
+        
+        unique_chunks = list(chunks)
+        if linked:
+            canonical_embeddings.update((chunk["id"], emb) for chunk, emb in zip(chunks, embeddings))
+            chunks = chunks + linked
+            embeddings = embeddings + [canonical_embeddings[d["canonical_id"]] for d in linked]
         
         # Store in database
-        db.upsert_documents(chunks, embeddings)
+        await run_blocking("upsert", db.upsert_documents, chunks, embeddings)
+        
+        if deduplicator is not None:
+            await run_blocking("dedup_commit", deduplicator.commit, source, unique_chunks, linked)
+        
+        # Cached session retrievals may no longer reflect the corpus
+        sessions.invalidate()
         
         elapsed_ms = int((time.time() - start_time) * 1000)
         
@@ -123,121 +289,317 @@ async def ingest(
             "message": "Content ingested successfully",
             "source": source,
             "chunks_created": len(chunks),
+            "duplicates_skipped": len(skipped),
+            "duplicates_linked": len(linked),
             "latency_ms": elapsed_ms
         }
     
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Server is busy, please retry later ({e.stage} stage saturated)",
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
 
 
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest):
+async def search_documents(query_embedding: List[float], top_k: int) -> List[Dict]:
+    """Similarity search with near-duplicate results collapsed."""
+    if deduplicator is None:
+        return await admission.run("search", db.similarity_search, query_embedding, top_k=top_k)
+    
+    def search_and_collapse():
+        # Over-fetch so collapsed duplicates don't leave top-k slots empty
+        docs = db.similarity_search(query_embedding, top_k=top_k * 2)
+        return deduplicator.collapse(docs)[:top_k]
+    
+    return await admission.run("search", search_and_collapse)
+
+
+async def retrieve_for_session(session: Session, question: str):
     """
-    Query the knowledge base and get an answer with citations.
+    Retrieve and rerank for a conversational turn, reusing session state.
     
-    - question: The question to ask
+    - Repeated question: reuse the cached candidates and rerank results.
+    - Follow-up: rescore the session's candidate pool against the new
+      embedding and only search again if the pool no longer covers it.
+    
+    Returns (retrieved_docs, reranked_docs, context_question, cached), where
+    context_question carries the previous question for follow-ups and
+    cached is True only for a repeated question, whose remaining LLM call
+    is admitted with priority.
     """
-    start_time = time.time()
+    # Captured before retrieval, so a concurrent ingest leaves this turn stale
+    corpus_version = sessions.corpus_version()
+    repeat = session.find_turn(question)
+    if repeat is not None:
+        print("Session cache hit: reusing retrieval for repeated question")
+        return session.turn_candidates(repeat), session.turn_reranked(repeat), repeat["context_question"], True
     
-    try:
-        if not request.question or len(request.question.strip()) < 3:
-            raise HTTPException(status_code=400, detail="Question is too short")
+    previous = session.last_turn()
+    query_embedding = await admission.run("embed", embedder.embed_query, question)
+    
+    if previous is None:
+        candidates = await search_documents(query_embedding, top_k=settings.top_k_retrieval)
+        context_question = question
+    else:
+        pool = session.candidate_pool()
+        scores = cosine_scores(query_embedding, pool)
+        ranked = sorted(range(len(pool)), key=lambda i: scores[i], reverse=True)
+        candidates = [dict(pool[i], similarity=float(scores[i])) for i in ranked[:settings.top_k_retrieval]]
         
-        print(f"\n=== QUERY DEBUG ===")
-        print(f"Question: {request.question}")
+        # The pool covers the follow-up only if its best match is good in absolute
+        # terms and close to how well the previous turn's retrieval matched
+        best = candidates[0]["similarity"] if candidates else 0.0
+        if (
+            best < settings.session_reuse_threshold
+            or best < previous["top_similarity"] * settings.session_reuse_ratio
+        ):
+            # Pool doesn't cover the follow-up well: extend it with a small search
+            print(f"Extending session candidates with top-{settings.session_extend_top_k} search")
+            known_ids = {doc.get("id") for doc in candidates}
+            fresh = await search_documents(query_embedding, top_k=settings.session_extend_top_k)
+            candidates += [doc for doc in fresh if doc.get("id") not in known_ids]
+            candidates.sort(key=lambda doc: doc.get("similarity", 0.0), reverse=True)
+            if deduplicator is not None:
+                candidates = await run_blocking("dedup", deduplicator.collapse, candidates)
+            candidates = candidates[:settings.top_k_retrieval]
+        else:
+            print(f"Reusing {len(candidates)} session candidates")
         
+        context_question = f"{previous['question']}\n{question}"
+    
+    reranked_docs = []
+    if candidates:
+        reranked_docs = await admission.run(
+            "rerank", reranker.rerank, context_question, candidates,
+            top_k=settings.top_k_rerank
+        )
+    
+    session.add_turn(question, context_question, candidates, reranked_docs, corpus_version)
+    return candidates, reranked_docs, context_question, False
+
+
+@app.post("/sessions")
+async def create_session():
+    """Start a conversation session; pass its id as session_id to /query."""
+    session = sessions.create()
+    return {"session_id": session.id, "ttl_seconds": settings.session_ttl_seconds}
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Discard a conversation session and its cached retrieval state."""
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"message": "Session deleted", "session_id": session_id}
+
+
+async def answer_query(request: QueryRequest, session: Optional[Session], start_time: float) -> QueryResponse:
+    """Run the embed -> search -> rerank -> LLM pipeline for one question."""
+    question = request.question
+    cached = False
+    if session is not None:
+        retrieved_docs, reranked_docs, question, cached = await retrieve_for_session(session, request.question)
+    else:
         # Generate query embedding
         print("Generating query embedding...")
-        query_embedding = embedder.embed_query(request.question)
+        query_embedding = await admission.run("embed", embedder.embed_query, request.question)
         print(f"Embedding generated: {len(query_embedding)} dimensions")
         print(f"First 5 values: {query_embedding[:5]}")
         
         # Retrieve top-k documents
         print(f"Searching for top-{settings.top_k_retrieval} documents...")
-        retrieved_docs = db.similarity_search(
+        retrieved_docs = await search_documents(
             query_embedding,
             top_k=settings.top_k_retrieval
         )
-        print(f"Retrieved {len(retrieved_docs)} documents")
-        
-        if not retrieved_docs:
-            print("ERROR: No documents retrieved!")
-            # Check if any documents exist in database
-            all_sources = db.get_all_sources()
-            print(f"Available sources in database: {all_sources}")
-            return QueryResponse(
-                answer="I couldn't find relevant information in the provided documents. Please make sure documents have been ingested first.",
-                citations=[],
-                latency_ms=int((time.time() - start_time) * 1000),
-                input_tokens=0,
-                output_tokens=0
-            )
-        
+    print(f"Retrieved {len(retrieved_docs)} documents")
+    
+    if not retrieved_docs:
+        print("ERROR: No documents retrieved!")
+        # Check if any documents exist in database
+        all_sources = await admission.run("search", db.get_all_sources)
+        print(f"Available sources in database: {all_sources}")
+        return QueryResponse(
+            answer="I couldn't find relevant information in the provided documents. Please make sure documents have been ingested first.",
+            citations=[],
+            latency_ms=int((time.time() - start_time) * 1000),
+            input_tokens=0,
+            output_tokens=0,
+            session_id=request.session_id
+        )
+    
+    if session is None:
         # Rerank documents
-        reranked_docs = reranker.rerank(
+        reranked_docs = await admission.run(
+            "rerank",
+            reranker.rerank,
             request.question,
             retrieved_docs,
             top_k=settings.top_k_rerank
         )
-        
-        # Generate answer with LLM
-        answer, citations, input_tokens, output_tokens = llm.generate_answer(
-            request.question,
-            reranked_docs
+    
+    # Generate answer with LLM
+    answer, citations, input_tokens, output_tokens = await admission.run(
+        "llm",
+        llm.generate_answer,
+        question,
+        reranked_docs,
+        priority=cached
+    )
+    
+    elapsed_ms = int((time.time() - start_time) * 1000)
+    
+    # Check if answer indicates no relevant information
+    no_info_indicators = [
+        "couldn't find relevant information",
+        "don't have information",
+        "no information available",
+        "not mentioned in the documents"
+    ]
+    
+    answer_lower = answer.lower()
+    has_no_info = any(indicator in answer_lower for indicator in no_info_indicators)
+    
+    warning = None
+    if has_no_info:
+        # Try generating with general knowledge
+        print("Context not relevant. Attempting general knowledge answer...")
+        general_answer, _, gen_input_tokens, gen_output_tokens = await admission.run(
+            "llm",
+            llm.generate_answer_with_general_knowledge,
+            question,
+            priority=cached
         )
         
-        elapsed_ms = int((time.time() - start_time) * 1000)
-        
-        # Check if answer indicates no relevant information
-        no_info_indicators = [
-            "couldn't find relevant information",
-            "don't have information",
-            "no information available",
-            "not mentioned in the documents"
-        ]
-        
-        answer_lower = answer.lower()
-        has_no_info = any(indicator in answer_lower for indicator in no_info_indicators)
-        
-        warning = None
-        if has_no_info:
-            # Try generating with general knowledge
-            print("Context not relevant. Attempting general knowledge answer...")
-            general_answer, _, gen_input_tokens, gen_output_tokens = llm.generate_answer_with_general_knowledge(
-                request.question
-            )
-            
-            warning = "⚠️ Your documents don't contain specific information about this query. This answer is generated from general AI knowledge. For more accurate answers, please upload relevant documentation."
-            
-            return QueryResponse(
-                answer=general_answer,
-                citations=citations,
-                latency_ms=elapsed_ms,
-                input_tokens=gen_input_tokens,
-                output_tokens=gen_output_tokens,
-                warning=warning
-            )
+        warning = "⚠️ Your documents don't contain specific information about this query. This answer is generated from general AI knowledge. For more accurate answers, please upload relevant documentation."
         
         return QueryResponse(
-            answer=answer,
+            answer=general_answer,
             citations=citations,
             latency_ms=elapsed_ms,
-            input_tokens=input_tokens,
-            output_tokens=output_tokens,
-            warning=None
+            input_tokens=gen_input_tokens,
+            output_tokens=gen_output_tokens,
+            warning=warning,
+            session_id=request.session_id
         )
     
+    return QueryResponse(
+        answer=answer,
+        citations=citations,
+        latency_ms=elapsed_ms,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        warning=None,
+        session_id=request.session_id
+    )
+
+
+@app.post("/query", response_model=QueryResponse)
+async def query(request: QueryRequest, profile: bool = False):
+    """
+    Query the knowledge base and get an answer with citations.
+    
+    - question: The question to ask
+    - session_id: Optional session from POST /sessions; follow-up questions
+      reuse that session's retrieval context
+    - profile: Capture a CPU/memory profile of this call (query parameter,
+      requires PROFILING_ENABLED); download it from /profiles/{profile_id}
+    
+    Concurrent identical stateless questions share one pipeline run. Returns
+    429 with Retry-After when a pipeline stage is saturated.
+    """
+    start_time = time.time()
+    
+    try:
+        if not request.question or len(request.question.strip()) < 3:
+            raise HTTPException(status_code=400, detail="Question is too short")
+        
+        print(f"\n=== QUERY DEBUG ===")
+        print(f"Question: {request.question}")
+        
+        session = None
+        if request.session_id:
+            session = sessions.get(request.session_id)
+            if session is None:
+                raise HTTPException(status_code=404, detail="Session not found or expired")
+        
+        with request_profiler(profile, "query") as profiler:
+            if session is not None or profiler is not None:
+                response = await answer_query(request, session, start_time)
+            else:
+                # Coalesce identical in-flight questions into a single pipeline run
+                key = SessionStore.normalise(request.question)
+                response, shared = await single_flight.do(key, lambda: answer_query(request, None, start_time))
+                if shared:
+                    print("Single-flight: joined in-flight query")
+                    response = response.model_copy(update={"latency_ms": int((time.time() - start_time) * 1000)})
+        
+        if profiler is not None:
+            response = response.model_copy(update={"profile_id": profiler.id})
+        return response
+    
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Server is busy, please retry later ({e.stage} stage saturated)",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
 
+@app.get("/profiles")
+async def list_profiles():
+    """List captured request profiles with per-stage timings and peak allocations."""
+    if not settings.profiling_enabled:
+        raise HTTPException(status_code=403, detail="Profiling is disabled. Set PROFILING_ENABLED=true to enable it.")
+    return {"profiles": profiles.list()}
+
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "summary"):
+    """
+    Download a captured profile.
+    
+    - format: "summary" (JSON stage timings), "speedscope" (sampled stacks,
+      open at https://www.speedscope.app) or "pstats" (load with pstats.Stats)
+    """
+    if not settings.profiling_enabled:
+        raise HTTPException(status_code=403, detail="Profiling is disabled. Set PROFILING_ENABLED=true to enable it.")
+    
+    profiler = profiles.get(profile_id)
+    if profiler is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    filename = f"{profiler.kind}-{profiler.id}"
+    if format == "summary":
+        return profiler.summary()
+    if format == "speedscope":
+        return JSONResponse(
+            profiler.to_speedscope(),
+            headers={"Content-Disposition": f'attachment; filename="{filename}.speedscope.json"'}
+        )
+    if format == "pstats":
+        return Response(
+            profiler.to_pstats(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.pstats"'}
+        )
+    raise HTTPException(status_code=400, detail="format must be one of: summary, speedscope, pstats")
+
+
 @app.get("/sources")
 async def get_sources():
     """Get all unique sources in the database."""
     try:
-        sources = db.get_all_sources()
+        sources = await run_in_threadpool(db.get_all_sources)
         return {"sources": sources, "count": len(sources)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving sources: {str(e)}")
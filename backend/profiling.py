@@ -0,0 +1,239 @@
+from typing import Callable, Dict, List, Optional
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import cProfile
+import marshal
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+
+class NullProfiler:
+    """Stand-in used when a request is not profiled; every hook is a no-op."""
+
+    id = None
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        return fn
+
+
+NULL_PROFILER = NullProfiler()
+
+# Profiler for the request being handled; read by AdmissionController.run
+current_profiler: ContextVar = ContextVar("current_profiler", default=NULL_PROFILER)
+
+
+class StackSampler(threading.Thread):
+    """Samples the Python stacks of registered threads at a fixed interval."""
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.threads: Dict[int, str] = {}  # thread ident -> current stage
+        self.samples: Dict[str, List[tuple]] = defaultdict(list)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, stage in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self.samples[stage].append(tuple(stack))
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class RequestProfiler:
+    """
+    Collects a sampling CPU profile, a deterministic cProfile and per-stage
+    tracemalloc peaks for one /ingest or /query call.
+    """
+
+    def __init__(self, kind: str, sample_interval: float = 0.005, active_fn: Optional[Callable[[], int]] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.created_at = time.time()
+        self.duration = 0.0
+        self.stages: List[Dict] = []
+        self._sampler = StackSampler(sample_interval)
+        self._cprofiles: List[cProfile.Profile] = []
+        self._started_tracemalloc = False
+        self._lock = threading.Lock()
+        # Requests in flight in this process, including the profiled one
+        self._active_fn = active_fn or (lambda: 1)
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._sampler.start()
+        self._start = time.perf_counter()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self._start
+        self._sampler.stop()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Profile the enclosed block as ``name`` in the current thread."""
+        ident = threading.get_ident()
+        others = self._active_fn() - 1
+        self._sampler.threads[ident] = name
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            others = max(others, self._active_fn() - 1, 0)
+            self._sampler.threads.pop(ident, None)
+            with self._lock:
+                self._cprofiles.append(profile)
+                self.stages.append({
+                    "stage": name,
+                    "seconds": round(elapsed, 6),
+                    "peak_alloc_bytes": max(peak - baseline, 0),
+                    "other_requests_in_flight": others
+                })
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        """Return ``fn`` wrapped in a stage, for calls run in another thread."""
+        def profiled(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return profiled
+
+    def summary(self) -> Dict:
+        return {
+            "profile_id": self.id,
+            "kind": self.kind,
+            "created_at": self.created_at,
+            "duration_seconds": round(self.duration, 6),
+            "stages": self.stages,
+            "note": (
+                "peak_alloc_bytes is traced process-wide and includes allocations "
+                "by the other requests in flight during a stage"
+            ),
+            "samples": sum(len(samples) for samples in self._sampler.samples.values())
+        }
+
+    def to_pstats(self) -> bytes:
+        """Merged cProfile stats in the marshal format read by pstats.Stats(path)."""
+        if not self._cprofiles:
+            return marshal.dumps({})
+        stats = pstats.Stats(self._cprofiles[0])
+        for profile in self._cprofiles[1:]:
+            stats.add(profile)
+        return marshal.dumps(stats.stats)
+
+    def to_speedscope(self) -> Dict:
+        """Sampled stacks in speedscope's file format, one profile per stage."""
+        frames: List[Dict] = []
+        frame_index: Dict[tuple, int] = {}
+        profiles = []
+
+        for stage, samples in self._sampler.samples.items():
+            indexed_samples = []
+            for stack in samples:
+                indexed = []
+                for name, filename, line in stack:
+                    key = (name, filename, line)
+                    if key not in frame_index:
+                        frame_index[key] = len(frames)
+                        frames.append({"name": name, "file": filename, "line": line})
+                    indexed.append(frame_index[key])
+                indexed_samples.append(indexed)
+
+            interval = self._sampler.interval
+            profiles.append({
+                "type": "sampled",
+                "name": f"{self.kind} {stage}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": interval * len(indexed_samples),
+                "samples": indexed_samples,
+                "weights": [interval] * len(indexed_samples)
+            })
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{self.kind} {self.id}",
+            "exporter": "rag-backend",
+            "shared": {"frames": frames},
+            "profiles": profiles
+        }
+
+
+class ProfileStore:
+    """
+    Keeps the most recent request profiles in memory for download.
+    Only one request is profiled at a time, since tracemalloc and the
+    cProfile hooks are process-wide; ``active_fn`` reports how many requests
+    the process is serving, so stages can record concurrent ones.
+    """
+
+    def __init__(
+        self,
+        max_profiles: int = 20,
+        sample_interval: float = 0.005,
+        active_fn: Optional[Callable[[], int]] = None
+    ):
+        self.max_profiles = max_profiles
+        self.sample_interval = sample_interval
+        self.active_fn = active_fn
+        self._profiles: "OrderedDict[str, RequestProfiler]" = OrderedDict()
+        self._active = threading.Lock()
+
+    @contextmanager
+    def profile(self, kind: str):
+        """
+        Profile the enclosed request and make it the current profiler.
+        Yields None if another request is already being profiled.
+        """
+        if not self._active.acquire(blocking=False):
+            yield None
+            return
+
+        profiler = RequestProfiler(kind, sample_interval=self.sample_interval, active_fn=self.active_fn)
+        token = current_profiler.set(profiler)
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            current_profiler.reset(token)
+            self._active.release()
+            self._profiles[profiler.id] = profiler
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[RequestProfiler]:
+        return self._profiles.get(profile_id)
+
+    def list(self) -> List[Dict]:
+        return [profiler.summary() for profiler in reversed(self._profiles.values())]
@@ -0,0 +1,211 @@
+import numpy as np
+from typing import Any, Callable, List, Dict, Optional
+from collections import OrderedDict, deque
+import threading
+import time
+import uuid
+
+
+class Session:
+    """
+    Recent retrieval state for one conversation.
+
+    Turns keep only chunk ids with their similarity and rerank scores; the
+    chunks themselves are stored once per session, with float32 embeddings,
+    and dropped when no remembered turn refers to them.
+    """
+
+    def __init__(self, session_id: str, max_turns: int):
+        self.id = session_id
+        self.turns = deque(maxlen=max_turns)
+        self.docs: Dict[str, Dict] = {}
+        self.last_access = time.time()
+
+    @staticmethod
+    def _doc_key(doc: Dict) -> str:
+        return doc.get("id") or f"{doc.get('source')}:{doc.get('chunk_index')}"
+
+    def _remember(self, doc: Dict) -> str:
+        key = self._doc_key(doc)
+        if key not in self.docs:
+            compact = {k: v for k, v in doc.items() if k not in ("similarity", "relevance_score")}
+            if compact.get("embedding") is not None:
+                compact["embedding"] = np.asarray(compact["embedding"], dtype=np.float32)
+            self.docs[key] = compact
+        return key
+
+    def _prune_docs(self):
+        referenced = {key for turn in self.turns for key, _ in turn["candidates"]}
+        referenced.update(key for turn in self.turns for key, _ in turn["reranked"])
+        self.docs = {key: doc for key, doc in self.docs.items() if key in referenced}
+
+    def last_turn(self) -> Optional[Dict]:
+        return self.turns[-1] if self.turns else None
+
+    def find_turn(self, question: str) -> Optional[Dict]:
+        """Return the most recent turn that asked exactly this question."""
+        key = SessionStore.normalise(question)
+        for turn in reversed(self.turns):
+            if turn["key"] == key:
+                return turn
+        return None
+
+    def turn_candidates(self, turn: Dict) -> List[Dict]:
+        """A turn's retrieved chunks, with their similarity scores."""
+        return [dict(self.docs[key], similarity=score) for key, score in turn["candidates"]]
+
+    def turn_reranked(self, turn: Dict) -> List[Dict]:
+        """A turn's reranked chunks, with their relevance scores."""
+        reranked = []
+        for key, score in turn["reranked"]:
+            doc = dict(self.docs[key])
+            if score is not None:
+                doc["relevance_score"] = score
+            reranked.append(doc)
+        return reranked
+
+    def candidate_pool(self) -> List[Dict]:
+        """Union of retrieved chunks across remembered turns, newest first."""
+        pool = []
+        seen = set()
+        for turn in reversed(self.turns):
+            for key, _ in turn["candidates"]:
+                if key in seen:
+                    continue
+                seen.add(key)
+                pool.append(self.docs[key])
+        return pool
+
+    def add_turn(
+        self,
+        question: str,
+        context_question: str,
+        candidates: List[Dict],
+        reranked: List[Dict],
+        corpus_version: Any = None
+    ):
+        top_similarity = max((doc.get("similarity", 0.0) for doc in candidates), default=0.0)
+        self.turns.append({
+            "key": SessionStore.normalise(question),
+            "question": question,
+            "context_question": context_question,
+            "candidates": [(self._remember(doc), doc.get("similarity", 0.0)) for doc in candidates],
+            "reranked": [(self._remember(doc), doc.get("relevance_score")) for doc in reranked],
+            "top_similarity": top_similarity,
+            "corpus_version": corpus_version,
+        })
+        self._prune_docs()
+
+    def drop_stale(self, corpus_version: Any):
+        """Forget turns retrieved against an older version of the corpus."""
+        fresh = [turn for turn in self.turns if turn["corpus_version"] == corpus_version]
+        if len(fresh) != len(self.turns):
+            self.turns = deque(fresh, maxlen=self.turns.maxlen)
+            self._prune_docs()
+
+
+class SessionStore:
+    """
+    Bounded, TTL-evicted in-memory store of conversation sessions.
+
+    State is per worker process, so multi-worker deployments need sticky
+    routing on the session id for follow-ups to hit the cache.
+
+    Cached turns are tagged with the corpus version they were retrieved
+    against and dropped once it changes: ``invalidate`` covers ingests in
+    this worker, and ``version_fn`` reports changes made elsewhere (such as
+    the shared index's content generation). A ``version_fn`` that makes a
+    network call should be given a ``version_poll_seconds``; it is then
+    polled in a background thread instead of on every lookup.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 1800,
+        max_sessions: int = 1000,
+        max_turns: int = 5,
+        version_fn: Optional[Callable[[], Any]] = None,
+        version_poll_seconds: float = 0.0
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.version_fn = version_fn
+        self._generation = 0
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._polled_version: Any = None
+        self._poll_seconds = version_poll_seconds
+        if version_fn is not None and version_poll_seconds > 0:
+            threading.Thread(target=self._poll_version, daemon=True).start()
+
+    def _poll_version(self):
+        while True:
+            try:
+                self._polled_version = self.version_fn()
+            except Exception as e:
+                print(f"Session corpus version poll failed: {e}")
+            time.sleep(self._poll_seconds)
+
+    def corpus_version(self) -> Any:
+        if self.version_fn is None:
+            external = None
+        elif self._poll_seconds > 0:
+            external = self._polled_version
+        else:
+            external = self.version_fn()
+        return (self._generation, external)
+
+    def invalidate(self):
+        """Mark every cached turn stale, e.g. after an ingest changed the corpus."""
+        with self._lock:
+            self._generation += 1
+
+    @staticmethod
+    def normalise(question: str) -> str:
+        return " ".join(question.lower().split())
+
+    def _evict_expired(self, now: float):
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_access < self.ttl_seconds:
+                break
+            self._sessions.popitem(last=False)
+
+    def create(self) -> Session:
+        now = time.time()
+        session = Session(uuid.uuid4().hex, self.max_turns)
+        with self._lock:
+            self._evict_expired(now)
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        """Return a live session and refresh its TTL, or None if unknown/expired."""
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_access = now
+            self._sessions.move_to_end(session_id)
+        session.drop_stale(self.corpus_version())
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+
+def cosine_scores(query_embedding: List[float], docs: List[Dict]) -> np.ndarray:
+    """Cosine similarity between a query and each doc's ``embedding``."""
+    if not docs:
+        return np.zeros(0, dtype=np.float32)
+    matrix = np.asarray([doc["embedding"] for doc in docs], dtype=np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * max(float(np.linalg.norm(query)), 1e-12)
+    return (matrix @ query) / np.maximum(norms, 1e-12)
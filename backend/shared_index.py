@@ -0,0 +1,498 @@
+import numpy as np
+from typing import List, Dict, Iterable, Optional, Tuple
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class SharedIndex:
+    """
+    Read-mostly vector index shared by every worker process on a host.
+
+    Vectors and metadata live in append-only segment files that each worker
+    memory-maps, so N workers share one copy through the page cache. Writers
+    append a new segment and atomically publish a new manifest; readers poll
+    the manifest and swap in the new view without a restart.
+
+    Segment layout (for segment ``<name>``):
+        <name>.vec   float32 [rows, dimension], L2-normalised
+        <name>.src   uint32  [rows], index into the segment's source list
+        <name>.meta  concatenated UTF-8 JSON records
+        <name>.off   uint64  [rows + 1], byte offsets into <name>.meta
+
+    The manifest maps every live source to the segment that currently owns
+    it, so re-ingesting or deleting a source never rewrites old segments;
+    stale rows are masked out. Compaction drops fully dead segments and
+    merges only segments that are mostly dead rows, or the smallest ones
+    when there are too many, streaming rows into the merged segment.
+
+    The manifest also records an opaque ``fingerprint`` of the system of
+    record it was last synced with; ``resync`` rebuilds the index when the
+    caller observes a different one. Its ``version`` changes on every
+    publish, ``generation`` only when the indexed content changes (not on
+    compaction).
+    """
+
+    MANIFEST = "manifest.json"
+    LOCK = "index.lock"
+
+    def __init__(
+        self,
+        root: str,
+        dimension: int,
+        refresh_interval: float = 2.0,
+        compact_interval: float = 300.0,
+        max_segments: int = 8,
+        compact_dead_ratio: float = 0.3
+    ):
+        self.root = root
+        self.dimension = dimension
+        self.refresh_interval = refresh_interval
+        self.compact_interval = compact_interval
+        self.max_segments = max_segments
+        self.compact_dead_ratio = compact_dead_ratio
+        os.makedirs(self.root, exist_ok=True)
+
+        self._view_lock = threading.Lock()
+        self._version = -1
+        self._generation = 0
+        self._segments: List[Dict] = []
+        self._thread: Optional[threading.Thread] = None
+        self.refresh()
+
+    # ------------------------------------------------------------------
+    # Background maintenance
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Start the background thread that reloads and compacts the index."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._maintenance_loop, daemon=True)
+        self._thread.start()
+
+    def _maintenance_loop(self):
+        last_compaction = time.time()
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+                if time.time() - last_compaction >= self.compact_interval:
+                    last_compaction = time.time()
+                    self.compact(blocking=False)
+            except Exception as e:
+                print(f"Shared index maintenance error: {e}")
+
+    # ------------------------------------------------------------------
+    # Manifest handling
+    # ------------------------------------------------------------------
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    @contextmanager
+    def _writer_lock(self, blocking: bool = True):
+        """Cross-process writer lock; yields False if non-blocking and busy."""
+        with open(self._path(self.LOCK), "a+") as lock_file:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> Dict:
+        try:
+            with open(self._path(self.MANIFEST), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"version": 0, "generation": 0, "dimension": self.dimension, "next_seq": 1, "segments": [], "sources": {}}
+
+    def _publish_manifest(self, manifest: Dict, content_changed: bool = True):
+        """Atomically replace the manifest so readers never see a partial file."""
+        manifest["version"] += 1
+        if content_changed:
+            manifest["generation"] = manifest.get("generation", 0) + 1
+        tmp_path = self._path(f"{self.MANIFEST}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(self.MANIFEST))
+
+    @property
+    def version(self) -> int:
+        """Manifest version of the currently loaded view."""
+        return self._version
+
+    @property
+    def generation(self) -> int:
+        """Content generation of the currently loaded view; compaction keeps it."""
+        return self._generation
+
+    def fingerprint(self) -> Optional[str]:
+        return self._read_manifest().get("fingerprint")
+
+    def _remove_segment_files(self, names: List[str]):
+        # Workers that still map the old files keep valid mappings on
+        # POSIX after unlink; they switch over on their next refresh.
+        for name in names:
+            for suffix in ("vec", "src", "meta", "off"):
+                try:
+                    os.remove(self._path(f"{name}.{suffix}"))
+                except FileNotFoundError:
+                    pass
+
+    def refresh(self) -> bool:
+        """Reload the view if a newer manifest was published. Returns True on reload."""
+        manifest = self._read_manifest()
+        if manifest["version"] == self._version:
+            return False
+        if manifest.get("dimension", self.dimension) != self.dimension:
+            raise ValueError(
+                f"Shared index at {self.root} has dimension {manifest['dimension']}, "
+                f"expected {self.dimension}"
+            )
+
+        try:
+            segments = [self._open_segment(seg, manifest["sources"]) for seg in manifest["segments"]]
+        except FileNotFoundError:
+            # A compaction removed a segment between reading the manifest and
+            # opening it; keep the current view and retry on the next poll.
+            return False
+
+        with self._view_lock:
+            self._segments = segments
+            self._version = manifest["version"]
+            self._generation = manifest.get("generation", 0)
+        return True
+
+    def _open_segment(self, seg: Dict, live_sources: Dict[str, int]) -> Dict:
+        name = seg["name"]
+        rows = seg["rows"]
+        if rows == 0:
+            vectors = np.zeros((0, self.dimension), dtype=np.float32)
+            source_ids = np.zeros(0, dtype=np.uint32)
+            offsets = np.zeros(1, dtype=np.uint64)
+            meta = b""
+        else:
+            vectors = np.memmap(self._path(f"{name}.vec"), dtype=np.float32, mode="r", shape=(rows, self.dimension))
+            source_ids = np.memmap(self._path(f"{name}.src"), dtype=np.uint32, mode="r", shape=(rows,))
+            offsets = np.memmap(self._path(f"{name}.off"), dtype=np.uint64, mode="r", shape=(rows + 1,))
+            meta = np.memmap(self._path(f"{name}.meta"), dtype=np.uint8, mode="r")
+
+        owned = np.array(
+            [live_sources.get(source) == seg["seq"] for source in seg["sources"]],
+            dtype=bool
+        )
+        live = owned[source_ids] if rows else np.zeros(0, dtype=bool)
+
+        return {
+            "name": name,
+            "seq": seg["seq"],
+            "sources": seg["sources"],
+            "source_ids": source_ids,
+            "vectors": vectors,
+            "offsets": offsets,
+            "meta": meta,
+            "live": live,
+            "live_rows": int(live.sum()),
+        }
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def _write_segment(self, name: str, blocks: Iterable[Tuple[np.ndarray, List[bytes], List[str]]]) -> Tuple[List[str], int]:
+        """
+        Write segment files from (vectors, metadata payloads, sources) blocks,
+        streaming each block to disk. Returns the segment's source list and
+        row count.
+        """
+        sources: List[str] = []
+        source_index: Dict[str, int] = {}
+        rows = 0
+        position = 0
+
+        files = {suffix: open(self._path(f"{name}.{suffix}"), "wb") for suffix in ("vec", "src", "meta", "off")}
+        try:
+            files["off"].write(np.zeros(1, dtype=np.uint64).tobytes())
+            for vectors, payloads, block_sources in blocks:
+                source_ids = np.empty(len(payloads), dtype=np.uint32)
+                offsets = np.empty(len(payloads), dtype=np.uint64)
+                for i, (payload, source) in enumerate(zip(payloads, block_sources)):
+                    if source not in source_index:
+                        source_index[source] = len(sources)
+                        sources.append(source)
+                    source_ids[i] = source_index[source]
+                    files["meta"].write(payload)
+                    position += len(payload)
+                    offsets[i] = position
+
+                files["vec"].write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                files["src"].write(source_ids.tobytes())
+                files["off"].write(offsets.tobytes())
+                rows += len(payloads)
+
+            for f in files.values():
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            for f in files.values():
+                f.close()
+
+        return sources, rows
+
+    def _normalise(self, embeddings: List[List[float]]) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected embeddings of dimension {self.dimension}, got {vectors.shape}")
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _add_segment(self, manifest: Dict, records: List[Dict], embeddings: List[List[float]]):
+        """Write a segment and register it in ``manifest`` (caller publishes)."""
+        vectors = self._normalise(embeddings)
+        metadata = [{key: value for key, value in record.items() if key != "embedding"} for record in records]
+
+        seq = manifest["next_seq"]
+        manifest["next_seq"] = seq + 1
+        name = f"seg-{seq:08d}-{uuid.uuid4().hex[:8]}"
+
+        payloads = [json.dumps(record, ensure_ascii=False).encode("utf-8") for record in metadata]
+        sources, _ = self._write_segment(name, [(vectors, payloads, [record["source"] for record in metadata])])
+        manifest["segments"].append({"name": name, "seq": seq, "rows": len(metadata), "sources": sources})
+        for source in sources:
+            manifest["sources"][source] = seq
+
+    def append(self, records: List[Dict], embeddings: List[List[float]], fingerprint: Optional[str] = None):
+        """
+        Append records as a new segment and publish it.
+        Every source present in ``records`` is (re)assigned to the new segment,
+        which supersedes its rows in older segments in the same publish, so
+        readers never see the source missing.
+        """
+        if not records:
+            return
+
+        with self._writer_lock():
+            manifest = self._read_manifest()
+            self._add_segment(manifest, records, embeddings)
+            if fingerprint is not None:
+                manifest["fingerprint"] = fingerprint
+            self._publish_manifest(manifest)
+
+        self.refresh()
+
+    def bulk_load(
+        self,
+        batches: Iterable[Tuple[List[Dict], List[List[float]]]],
+        only_if_empty: bool = False,
+        fingerprint: Optional[str] = None
+    ) -> int:
+        """
+        Load many (records, embeddings) batches under a single writer lock and
+        publish them with one manifest update. A source must not span batches,
+        since each batch supersedes earlier rows of the sources it contains.
+        With ``only_if_empty`` the load is skipped if another worker already
+        populated the index. Returns the number of rows loaded.
+        """
+        total = 0
+        with self._writer_lock():
+            manifest = self._read_manifest()
+            if only_if_empty and manifest["sources"]:
+                return 0
+
+            for records, embeddings in batches:
+                if not records:
+                    continue
+                self._add_segment(manifest, records, embeddings)
+                total += len(records)
+
+            if fingerprint is not None:
+                manifest["fingerprint"] = fingerprint
+            if total or fingerprint is not None:
+                self._publish_manifest(manifest, content_changed=bool(total))
+
+        self.refresh()
+        return total
+
+    def resync(self, fingerprint: str, batches: Iterable[Tuple[List[Dict], List[List[float]]]]) -> bool:
+        """
+        Replace the whole index with ``batches`` unless it is already at
+        ``fingerprint``. Non-blocking: if another worker holds the writer lock
+        the resync is skipped and retried on the caller's next poll.
+        """
+        with self._writer_lock(blocking=False) as acquired:
+            if not acquired:
+                return False
+
+            manifest = self._read_manifest()
+            if manifest.get("fingerprint") == fingerprint:
+                return False
+
+            old_names = [seg["name"] for seg in manifest["segments"]]
+            manifest["segments"] = []
+            manifest["sources"] = {}
+            total = 0
+            for records, embeddings in batches:
+                if not records:
+                    continue
+                self._add_segment(manifest, records, embeddings)
+                total += len(records)
+
+            manifest["fingerprint"] = fingerprint
+            self._publish_manifest(manifest)
+            self._remove_segment_files(old_names)
+            print(f"Shared index resynced: {total} rows")
+
+        self.refresh()
+        return True
+
+    def delete_sources(self, sources: List[str], fingerprint: Optional[str] = None):
+        """Mask the rows of several sources with a single manifest update."""
+        with self._writer_lock():
+            manifest = self._read_manifest()
+            present = [source for source in sources if source in manifest["sources"]]
+            if not present and fingerprint is None:
+                return
+            for source in present:
+                del manifest["sources"][source]
+            if fingerprint is not None:
+                manifest["fingerprint"] = fingerprint
+            self._publish_manifest(manifest, content_changed=bool(present))
+
+        self.refresh()
+
+    def _compaction_plan(self, segments: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Pick (segments to drop, segments to merge). Fully dead segments are
+        dropped without a rewrite; segments whose dead share reaches
+        ``compact_dead_ratio`` are merged, plus the smallest segments while
+        there are more than ``max_segments``.
+        """
+        dead = [seg for seg in segments if seg["live_rows"] == 0]
+        remaining = [seg for seg in segments if seg["live_rows"] > 0]
+        merge = [
+            seg for seg in remaining
+            if 1 - seg["live_rows"] / len(seg["live"]) >= self.compact_dead_ratio
+        ]
+
+        others = sorted((seg for seg in remaining if seg not in merge), key=lambda seg: seg["live_rows"])
+        # Merging k segments into one leaves len(remaining) - k + 1
+        while others and len(remaining) - len(merge) + (1 if merge else 0) > self.max_segments:
+            merge.append(others.pop(0))
+        if len(merge) == 1 and merge[0]["live_rows"] == len(merge[0]["live"]):
+            merge = []
+        return dead, merge
+
+    def _live_blocks(self, segments: List[Dict], block_rows: int = 4096):
+        """Yield live rows of ``segments`` as (vectors, payloads, sources) blocks."""
+        for seg in segments:
+            rows = np.flatnonzero(seg["live"])
+            for start in range(0, len(rows), block_rows):
+                block = rows[start:start + block_rows]
+                payloads = [
+                    bytes(seg["meta"][int(seg["offsets"][row]):int(seg["offsets"][row + 1])])
+                    for row in block
+                ]
+                sources = [seg["sources"][seg["source_ids"][row]] for row in block]
+                yield np.asarray(seg["vectors"][block]), payloads, sources
+
+    def compact(self, blocking: bool = True) -> bool:
+        """
+        Drop dead segments and merge fragmented or small ones (see
+        ``_compaction_plan``); other segments are left untouched.
+        Runs in at most one process at a time; with ``blocking=False`` it is a
+        no-op if another worker already holds the writer lock.
+        """
+        with self._writer_lock(blocking=blocking) as acquired:
+            if not acquired:
+                return False
+
+            manifest = self._read_manifest()
+            segments = [self._open_segment(seg, manifest["sources"]) for seg in manifest["segments"]]
+            dead, merge = self._compaction_plan(segments)
+            if not dead and not merge:
+                return False
+
+            removed = {seg["name"] for seg in dead + merge}
+            manifest["segments"] = [seg for seg in manifest["segments"] if seg["name"] not in removed]
+
+            rows = 0
+            if merge:
+                seq = manifest["next_seq"]
+                manifest["next_seq"] = seq + 1
+                name = f"seg-{seq:08d}-{uuid.uuid4().hex[:8]}"
+                sources, rows = self._write_segment(name, self._live_blocks(merge))
+                manifest["segments"].append({"name": name, "seq": seq, "rows": rows, "sources": sources})
+                for source in sources:
+                    manifest["sources"][source] = seq
+
+            self._publish_manifest(manifest, content_changed=False)
+            self._remove_segment_files(sorted(removed))
+
+            print(f"Shared index compaction: dropped {len(dead)} dead segments, merged {len(merge)} into one ({rows} rows)")
+
+        self.refresh()
+        return True
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _load_records(seg: Dict, rows) -> List[Dict]:
+        records = []
+        for row in rows:
+            start = int(seg["offsets"][row])
+            end = int(seg["offsets"][row + 1])
+            records.append(json.loads(bytes(seg["meta"][start:end]).decode("utf-8")))
+        return records
+
+    def count(self) -> int:
+        with self._view_lock:
+            return sum(seg["live_rows"] for seg in self._segments)
+
+    def is_empty(self) -> bool:
+        return self.count() == 0
+
+    def search(self, query_embedding: List[float], top_k: int = 8) -> List[Dict]:
+        """
+        Cosine-similarity search over all live rows.
+        Returns records shaped like ``match_documents`` rows, with ``embedding``
+        and ``similarity``.
+        """
+        with self._view_lock:
+            segments = self._segments
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        candidates = []
+        for seg_index, seg in enumerate(segments):
+            if seg["live_rows"] == 0:
+                continue
+            scores = seg["vectors"] @ query
+            scores = np.where(seg["live"], scores, -np.inf)
+            k = min(top_k, seg["live_rows"])
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates.extend((float(scores[row]), seg_index, int(row)) for row in top)
+
+        candidates.sort(key=lambda item: item[0], reverse=True)
+
+        results = []
+        for score, seg_index, row in candidates[:top_k]:
+            record = self._load_records(segments[seg_index], [row])[0]
+            record["embedding"] = segments[seg_index]["vectors"][row].tolist()
+            record["similarity"] = score
+            results.append(record)
+        return results
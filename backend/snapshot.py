@@ -0,0 +1,220 @@
+"""
+Corpus snapshots: export every chunk, its metadata and embedding to a single
+file, and load it back without calling the embedding provider.
+
+A snapshot is a zip archive readable with numpy.load:
+    manifest.json             format version, embedding model, dimension, shards
+    embeddings_000000.npy     float32 [rows, dimension]
+    chunks_000000.jsonl       one JSON record per row, same order
+
+Shards are written as they are read from the database, so memory use is
+bounded by the shard size, and a source never spans two shards.
+
+Usage:
+    python snapshot.py export corpus.npz
+    python snapshot.py import corpus.npz [--target database|index] [--force]
+
+--target index loads only this host's shared index, as a read replica.
+"""
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import io
+import json
+import os
+import time
+import zipfile
+
+from config import get_settings
+
+FORMAT_VERSION = 1
+CHUNK_FIELDS = ("id", "content", "source", "title", "section", "chunk_index")
+
+
+def _open_member(archive: zipfile.ZipFile, name: str, compress_type: int):
+    """Open a new archive member for streaming writes."""
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    return archive.open(info, "w", force_zip64=True)
+
+
+def export_snapshot(db, path: str, batch_size: int = 1000) -> Dict:
+    """
+    Stream the whole corpus from ``db`` into a snapshot at ``path``.
+    The exported row count must match the table's exact count; otherwise
+    the incomplete snapshot is deleted and ValueError is raised.
+    """
+    settings = get_settings()
+    shards = []
+    sources = set()
+    total = 0
+    expected = db.count_documents()
+
+    try:
+        with zipfile.ZipFile(path, "w", allowZip64=True) as archive:
+            for shard_number, rows in enumerate(db.iter_source_batches(batch_size)):
+                name = f"{shard_number:06d}"
+                vectors = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+                if vectors.shape[1] != settings.embedding_dimension:
+                    raise ValueError(
+                        f"Stored embeddings have dimension {vectors.shape[1]}, "
+                        f"expected {settings.embedding_dimension}"
+                    )
+
+                # Embeddings barely compress, so store them uncompressed
+                with _open_member(archive, f"embeddings_{name}.npy", zipfile.ZIP_STORED) as f:
+                    np.lib.format.write_array(f, vectors, allow_pickle=False)
+
+                with _open_member(archive, f"chunks_{name}.jsonl", zipfile.ZIP_DEFLATED) as f:
+                    for row in rows:
+                        record = {field: row.get(field) for field in CHUNK_FIELDS}
+                        f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                        sources.add(row["source"])
+
+                shards.append({"name": name, "rows": len(rows)})
+                total += len(rows)
+                print(f"Exported shard {name}: {len(rows)} chunks")
+
+            if total != expected:
+                raise ValueError(
+                    f"Exported {total} chunks but the table holds {expected}; "
+                    f"the corpus changed during export or pages were truncated"
+                )
+
+            manifest = {
+                "format_version": FORMAT_VERSION,
+                "created_at": time.time(),
+                "embedding_model": settings.embedding_model,
+                "embedding_dimension": settings.embedding_dimension,
+                "rows": total,
+                "sources": sorted(sources),
+                "shards": shards
+            }
+            archive.writestr("manifest.json", json.dumps(manifest, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    return manifest
+
+
+def read_manifest(path: str) -> Dict:
+    with zipfile.ZipFile(path, "r") as archive:
+        return json.loads(archive.read("manifest.json"))
+
+
+def iter_snapshot(path: str) -> Iterator[Tuple[List[Dict], np.ndarray]]:
+    """Yield (records, embeddings) per shard, without loading the whole file."""
+    with zipfile.ZipFile(path, "r") as archive:
+        manifest = json.loads(archive.read("manifest.json"))
+        for shard in manifest["shards"]:
+            with archive.open(f"embeddings_{shard['name']}.npy") as f:
+                vectors = np.lib.format.read_array(f, allow_pickle=False)
+            with archive.open(f"chunks_{shard['name']}.jsonl") as f:
+                records = [json.loads(line) for line in io.TextIOWrapper(f, encoding="utf-8")]
+            if len(records) != len(vectors):
+                raise ValueError(f"Snapshot shard {shard['name']} is corrupt: {len(records)} chunks, {len(vectors)} embeddings")
+            yield records, vectors
+
+
+def check_compatible(manifest: Dict, force: bool = False):
+    """Refuse snapshots whose embeddings don't match the configured model."""
+    settings = get_settings()
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version: {manifest.get('format_version')}")
+    if manifest["embedding_dimension"] != settings.embedding_dimension:
+        raise ValueError(
+            f"Snapshot dimension {manifest['embedding_dimension']} does not match "
+            f"configured dimension {settings.embedding_dimension}"
+        )
+    if manifest["embedding_model"] != settings.embedding_model and not force:
+        raise ValueError(
+            f"Snapshot was embedded with {manifest['embedding_model']}, "
+            f"but {settings.embedding_model} is configured (use --force to import anyway)"
+        )
+
+
+def import_to_database(db, path: str, force: bool = False, batch_size: int = 500) -> int:
+    """
+    Load a snapshot into Supabase with batched upserts, keeping chunk ids.
+    Sources in the snapshot replace any existing rows of the same source,
+    one shard at a time (see VectorDatabase.replace_sources). An interrupted
+    import can leave stale rows next to the new ones; re-run it to finish.
+    """
+    manifest = read_manifest(path)
+    check_compatible(manifest, force=force)
+
+    total = 0
+    for records, vectors in iter_snapshot(path):
+        for record, vector in zip(records, vectors):
+            record["embedding"] = vector.tolist()
+        db.replace_sources(records, batch_size=batch_size)
+        total += len(records)
+        print(f"Imported {total}/{manifest['rows']} chunks")
+
+    return total
+
+
+def import_to_index(index, path: str, force: bool = False) -> int:
+    """
+    Load a snapshot straight into the shared local index, bypassing Supabase.
+    The index then serves as a read replica: Supabase and the dedup index are
+    not updated, so the host should not ingest and must not resync the index
+    from Supabase.
+    """
+    manifest = read_manifest(path)
+    check_compatible(manifest, force=force)
+    return index.bulk_load(iter_snapshot(path))
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Export or import a corpus snapshot.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write every chunk and embedding to a snapshot")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--batch-size", type=int, default=1000)
+
+    import_parser = subparsers.add_parser("import", help="Load a snapshot without re-embedding")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--target", choices=["database", "index"], default="database")
+    import_parser.add_argument("--batch-size", type=int, default=500)
+    import_parser.add_argument("--force", action="store_true", help="Import even if the embedding model differs")
+
+    args = parser.parse_args(argv)
+    settings = get_settings()
+    start_time = time.time()
+
+    if args.command == "export":
+        from database import VectorDatabase
+        manifest = export_snapshot(VectorDatabase(start_background=False), args.path, batch_size=args.batch_size)
+        print(f"Exported {manifest['rows']} chunks from {len(manifest['sources'])} sources to {args.path}")
+    elif args.target == "index":
+        from shared_index import SharedIndex
+        if not settings.shared_index_dir:
+            parser.error("SHARED_INDEX_DIR must be set to import into the local index")
+        if settings.shared_index_resync_seconds > 0:
+            parser.error(
+                "--target index makes the local index a read replica that Supabase does not have; "
+                "set SHARED_INDEX_RESYNC_SECONDS=0 so the periodic resync does not replace it"
+            )
+        index = SharedIndex(settings.shared_index_dir, dimension=settings.embedding_dimension)
+        total = import_to_index(index, args.path, force=args.force)
+        print(f"Loaded {total} chunks into {settings.shared_index_dir}")
+    else:
+        from database import VectorDatabase
+        db = VectorDatabase(start_background=False)
+        total = import_to_database(db, args.path, force=args.force, batch_size=args.batch_size)
+        print(f"Imported {total} chunks into Supabase")
+
+        if settings.dedup_enabled:
+            from dedup import ChunkDeduplicator
+            deduplicator = ChunkDeduplicator(settings.dedup_index_path, threshold=settings.dedup_threshold)
+            deduplicator.rebuild(db.iter_documents(with_embeddings=False))
+
+    print(f"Done in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
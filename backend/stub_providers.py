@@ -0,0 +1,209 @@
+"""
+Offline stand-ins for the external providers (Google embeddings, Cohere
+rerank, Gemini, Supabase), enabled with USE_STUB_PROVIDERS=true. Each stub
+counts its calls so provider usage can be measured without API keys.
+
+Run ``python stub_providers.py`` to replay a short conversation through the
+real /query pipeline and print the provider calls each turn made.
+"""
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+import hashlib
+import re
+import uuid
+
+from config import get_settings
+
+
+def _tokens(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class StubEmbedder:
+    """Deterministic hashed bag-of-words embeddings."""
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.calls = 0
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.settings.embedding_dimension, dtype=np.float32)
+        for token in _tokens(text):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % len(vector)
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = float(np.linalg.norm(vector))
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, query: str) -> List[float]:
+        self.calls += 1
+        return self._embed(query)
+
+
+class StubReranker:
+    """Scores documents by token overlap with the query."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def rerank(self, query: str, documents: List[Dict], top_k: int = 4) -> List[Dict]:
+        if not documents:
+            return []
+        self.calls += 1
+        query_tokens = set(_tokens(query))
+        scored = []
+        for doc in documents:
+            doc_tokens = set(_tokens(doc["content"]))
+            score = len(query_tokens & doc_tokens) / max(len(query_tokens), 1)
+            scored.append(dict(doc, relevance_score=score))
+        scored.sort(key=lambda doc: doc["relevance_score"], reverse=True)
+        return scored[:top_k]
+
+
+class StubLLMAnswerer:
+    """Answers by quoting the top context documents with citations."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate_answer(self, query: str, context_docs: List[Dict]) -> Tuple[str, List[Dict], int, int]:
+        if not context_docs:
+            return "I couldn't find relevant information in the provided documents.", [], 0, 0
+        self.calls += 1
+        answer = " ".join(f"{doc['content'][:80]} [{i}]" for i, doc in enumerate(context_docs[:2], 1))
+        citations = [
+            {
+                "number": i,
+                "source": doc.get("source", "Unknown"),
+                "section": doc.get("section", ""),
+                "content": doc.get("content", "")[:300]
+            }
+            for i, doc in enumerate(context_docs[:2], 1)
+        ]
+        return answer, citations, len(_tokens(query)), len(_tokens(answer))
+
+    def generate_answer_with_general_knowledge(self, query: str) -> Tuple[str, List[Dict], int, int]:
+        self.calls += 1
+        answer = "Based on general knowledge: this is a stub answer."
+        return answer, [], len(_tokens(query)), len(_tokens(answer))
+
+
+class StubVectorDatabase:
+    """In-memory replacement for VectorDatabase with brute-force cosine search."""
+
+    def __init__(self):
+        self.rows: Dict[str, Dict] = {}
+        self.local_index = None
+        self.calls = 0
+        self.writes = 0
+
+    def upsert_documents(self, chunks: List[Dict], embeddings: List[List[float]]):
+        if not chunks:
+            return
+        self.delete_by_source(chunks[0]["source"])
+        self.writes += 1
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk_id = chunk.get("id") or str(uuid.uuid4())
+            self.rows[chunk_id] = {
+                "id": chunk_id,
+                "content": chunk["content"],
+                "embedding": list(embedding),
+                "source": chunk["source"],
+                "title": chunk["title"],
+                "section": chunk.get("section", ""),
+                "chunk_index": chunk["chunk_index"]
+            }
+
+    def delete_by_source(self, source: str):
+        self.writes += 1
+        self.rows = {key: row for key, row in self.rows.items() if row["source"] != source}
+
+    def corpus_fingerprint(self) -> str:
+        return f"{len(self.rows)}:{self.writes}"
+
+    def get_embeddings(self, ids: List[str]) -> Dict[str, List[float]]:
+        return {chunk_id: self.rows[chunk_id]["embedding"] for chunk_id in ids if chunk_id in self.rows}
+
+    def iter_documents(self, batch_size: int = 1000, with_embeddings: bool = True) -> Iterator[List[Dict]]:
+        rows = sorted(self.rows.values(), key=lambda row: (row["source"], row["chunk_index"]))
+        for i in range(0, len(rows), batch_size):
+            batch = [dict(row) for row in rows[i:i + batch_size]]
+            if not with_embeddings:
+                for row in batch:
+                    row.pop("embedding")
+            yield batch
+
+    def similarity_search(self, query_embedding: List[float], top_k: int = 8) -> List[Dict]:
+        self.calls += 1
+        if not self.rows:
+            return []
+        rows = list(self.rows.values())
+        matrix = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = matrix @ query / np.maximum(np.linalg.norm(matrix, axis=1) * max(float(np.linalg.norm(query)), 1e-12), 1e-12)
+        order = np.argsort(-scores)[:top_k]
+        return [dict(rows[i], similarity=float(scores[i])) for i in order]
+
+    def get_all_sources(self) -> List[str]:
+        return sorted({row["source"] for row in self.rows.values()})
+
+
+def _demo():
+    import asyncio
+    import os
+    import tempfile
+
+    os.environ["USE_STUB_PROVIDERS"] = "true"
+    # Hashed bag-of-words similarities run far lower than real embeddings'
+    os.environ.setdefault("SESSION_REUSE_THRESHOLD", "0.1")
+    os.environ.setdefault("DEDUP_INDEX_PATH", os.path.join(tempfile.mkdtemp(), "dedup_index.sqlite"))
+    for key in ("SUPABASE_URL", "SUPABASE_SERVICE_KEY", "GOOGLE_API_KEY", "COHERE_API_KEY"):
+        os.environ.setdefault(key, "stub")
+
+    import main
+
+    text = (
+        "Deployment options\n\n"
+        "Option one is Render, a managed platform that deploys the FastAPI backend from git.\n\n"
+        "Option two is Docker, which packages the backend into a container for any host.\n\n"
+        "Option three is a plain virtual machine running uvicorn behind nginx."
+    )
+
+    def provider_calls() -> Dict[str, int]:
+        return {
+            "embed": main.embedder.calls,
+            "search": main.db.calls,
+            "rerank": main.reranker.calls,
+            "llm": main.llm.calls
+        }
+
+    async def ask(label: str, question: str, session_id: Optional[str]):
+        before = provider_calls()
+        session = main.sessions.get(session_id) if session_id else None
+        request = main.QueryRequest(question=question, session_id=session_id)
+        await main.answer_query(request, session, 0.0)
+        after = provider_calls()
+        print(f"{label:<24} {question!r}: {({name: after[name] - before[name] for name in after})}")
+
+    async def run():
+        await main.ingest_content(text, None)
+        session_id = main.sessions.create().id
+        first, follow_up = "What deployment options are available?", "What about the second option?"
+
+        await ask("session, first turn", first, session_id)
+        await ask("session, follow-up", follow_up, session_id)
+        await ask("session, repeat", follow_up, session_id)
+        await ask("stateless", follow_up, None)
+
+        await main.ingest_content("Option four is Kubernetes, for teams that already run a cluster.", None)
+        await ask("session, after ingest", follow_up, session_id)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    _demo()